@@ -5,10 +5,16 @@ is a vacancy.
 """
 
 import typing
+import datetime as dt
+import re
+from array import array
 import selenium.webdriver.remote.webelement as we
+from selenium.common.exceptions import WebDriverException
 import warnings
 import logging
 
+import ccb.throttle as thr
+
 
 # Set default message from config to be info, and prettier format:
 logging.basicConfig(format='%(asctime)s --> %(levelname)s: %(message)s', level=logging.INFO)
@@ -132,6 +138,19 @@ class Hour:
     def minutes(self, mins: str) -> None:
         self._minutes = int(mins)
 
+    def to_time(self) -> dt.time:
+        """Returns the hour as a dt.time object. """
+        return dt.time(self.hour, self.minutes)
+
+    def to_minutes(self) -> int:
+        """Returns the minutes since midnight. """
+        return self.hour * 60 + self.minutes
+
+    @classmethod
+    def from_minutes(cls, minutes: int) -> 'Hour':
+        """Creates an Hour from the minutes since midnight. """
+        return cls('{:02d}:{:02d}'.format(minutes // 60, minutes % 60))
+
     def __eq__(self, other: 'Hour') -> bool:
         if not isinstance(other, Hour):
             raise ValueError('{} must be an Hour instance.'.format(other))
@@ -189,6 +208,8 @@ class Schedule:
     True
     >>> hour2 in schedule
     False
+    >>> schedule.start in schedule
+    True
     """
     def __init__(self, sch: str) -> None:
         self._sch = sch
@@ -203,7 +224,8 @@ class Schedule:
         return self._sch
 
     def __contains__(self, item: Hour) -> bool:
-        return self.start < item < self.end
+        # A class contains its start hour, the hour written in the config file.
+        return self.start.to_minutes() <= item.to_minutes() < self.end.to_minutes()
 
     @property
     def start(self) -> Hour:
@@ -224,6 +246,163 @@ class Schedule:
         self._end = Hour(end_)
 
 
+# Whole columns of the table are checked and parsed at once, one cell per line.
+_RESERVATIONS_RE = re.compile(r'(?:[ \t]*\(\d+/\d+\)[ \t]*\n)*[ \t]*\(\d+/\d+\)[ \t]*')
+_SCHEDULES_RE = re.compile(r'(?:[ \t]*\d+:\d+ - \d+:\d+[ \t]*\n)*[ \t]*\d+:\d+ - \d+:\d+[ \t]*')
+_NUMBER_RE = re.compile(r'\d+')
+# The same formats for a single cell, used when a column has bad cells.
+_RESERVATION_RE = re.compile(r'[ \t]*\((\d+)/(\d+)\)[ \t]*')
+_SCHEDULE_RE = re.compile(r'[ \t]*(\d+):(\d+) - (\d+):(\d+)[ \t]*')
+
+
+def _parse_numbers(
+        column: typing.Sequence[str], pattern: typing.Pattern, cell_pattern: typing.Pattern, per_cell: int
+) -> typing.Tuple[array, bytes]:
+    """Checks a whole column against pattern and returns every number in it,
+    per_cell numbers per row, and a mask with 1 on the rows well formatted.
+
+    When the column doesn't match, the cells are parsed one by one with
+    cell_pattern, and the bad ones are logged and get zeros as numbers.
+    """
+    if len(column) == 0:
+        return array('H'), bytes()
+    text = '\n'.join(column)
+    try:
+        numbers = array('H', map(int, _NUMBER_RE.findall(text)))
+        if pattern.fullmatch(text) is not None and len(numbers) == per_cell * len(column):
+            return numbers, bytes([1]) * len(column)
+    except OverflowError:
+        pass
+
+    numbers = array('H')
+    valid = bytearray()
+    for cell in column:
+        match = cell_pattern.fullmatch(cell)
+        try:
+            row = array('H', map(int, match.groups())) if match is not None else None
+        except OverflowError:
+            row = None
+        if row is None:
+            logging.warning('Bad format in cell, row not bookable: {}'.format(cell))
+            row = array('H', [0] * per_cell)
+            valid.append(0)
+        else:
+            valid.append(1)
+        numbers.extend(row)
+    return numbers, bytes(valid)
+
+
+class ReservationColumns:
+    """Columns of places parsed from the 'Reservas' cells of a table,
+    the bulk counterpart of Reservation.
+
+    Parameters
+    ----------
+    places : array
+        Number of places of each row.
+    total : array
+        Total number of places of each row.
+    valid : bytes or None
+        Mask with 1 on the rows well formatted. Defaults to None, every row.
+
+    Attributes
+    ----------
+    free
+        Mask with 1 on the valid rows with a place, see Reservation.is_free.
+    """
+    def __init__(self, places: array, total: array, valid: typing.Union[bytes, None] = None) -> None:
+        self.places = places
+        self.total = total
+        self.valid = valid if valid is not None else bytes([1]) * len(places)
+        self.free = bytes(v and p < t for v, p, t in zip(self.valid, places, total))
+
+    def __repr__(self):
+        return '{}({} rows, {} free)'.format(self.__class__.__name__, len(self), sum(self.free))
+
+    def __len__(self):
+        return len(self.places)
+
+
+class ScheduleColumns:
+    """Columns of hours parsed from the 'Horario' cells of a table,
+    the bulk counterpart of Schedule.
+
+    Parameters
+    ----------
+    start : array
+        Start of each row, in minutes since midnight.
+    end : array
+        End of each row, in minutes since midnight.
+    valid : bytes or None
+        Mask with 1 on the rows well formatted. Defaults to None, every row.
+    """
+    def __init__(self, start: array, end: array, valid: typing.Union[bytes, None] = None) -> None:
+        self.start = start
+        self.end = end
+        self.valid = valid if valid is not None else bytes([1]) * len(start)
+
+    def __repr__(self):
+        return '{}({} rows)'.format(self.__class__.__name__, len(self))
+
+    def __len__(self):
+        return len(self.start)
+
+    def containing(self, hour: Hour) -> bytes:
+        """Mask with 1 on the rows whose schedule contains hour, see Schedule.__contains__. """
+        minutes = hour.to_minutes()
+        return bytes(v and s <= minutes < e for v, s, e in zip(self.valid, self.start, self.end))
+
+
+def parse_reservations(column: typing.Sequence[str]) -> ReservationColumns:
+    """Parses a whole column of reservations in one pass.
+
+    Parameters
+    ----------
+    column : sequence of str
+        Cells of the format (<PLACES_LEFT>/<TOTAL_PLACES>). The cells with
+        another format are logged and their rows are not free.
+
+    Returns
+    -------
+    columns : ReservationColumns
+
+    Examples
+    --------
+    >>> reservations = parse_reservations(['(13/15)', '(15/15)'])
+    >>> list(reservations.places), list(reservations.total), list(reservations.free)
+    ([13, 15], [15, 15], [1, 0])
+    >>> list(parse_reservations(['(13/15)', 'Completa']).free)
+    [1, 0]
+    """
+    numbers, valid = _parse_numbers(column, _RESERVATIONS_RE, _RESERVATION_RE, 2)
+    return ReservationColumns(numbers[0::2], numbers[1::2], valid=valid)
+
+
+def parse_schedules(column: typing.Sequence[str]) -> ScheduleColumns:
+    """Parses a whole column of schedules in one pass.
+
+    Parameters
+    ----------
+    column : sequence of str
+        Cells of the format 'hh:mm - hh:mm'. The cells with another format
+        are logged and their rows contain no hour.
+
+    Returns
+    -------
+    columns : ScheduleColumns
+
+    Examples
+    --------
+    >>> schedules = parse_schedules(['11:00 - 13:00', '19:00 - 20:00'])
+    >>> list(schedules.start), list(schedules.end)
+    ([660, 1140], [780, 1200])
+    """
+    numbers, valid = _parse_numbers(column, _SCHEDULES_RE, _SCHEDULE_RE, 4)
+    start = array('H', [h * 60 + m for h, m in zip(numbers[0::4], numbers[1::4])])
+    end = array('H', [h * 60 + m for h, m in zip(numbers[2::4], numbers[3::4])])
+    return ScheduleColumns(start, end, valid=valid)
+
+
 class ButtonIcon:
     """
     Reference for plus/minus icons of a button.
@@ -239,6 +418,19 @@ class Button:
     """
     Element of selenium representing the button to be pressed to book a class.
 
+    Parameters
+    ----------
+    element : WebElement or str
+        Element to be clicked, or the text found in its place when
+        there is no button.
+    driver : WebDriver
+        Driver the element belongs to.
+    icon : str or None
+        Class of the icon of the button.
+    limiter : thr.RateLimiter or None
+        Rate limiter shared with CCB, the click is sent through
+        its BOOKING lane.
+
     TODO:
         determinar si un botón es glyphicon-minus para NO clickar.
     """
@@ -246,6 +438,7 @@ class Button:
             self, element: typing.Union[we.WebElement, str],
             driver: "WebDriver",
             icon: typing.Union[str, None] = None,
+            limiter: typing.Union[thr.RateLimiter, None] = None,
     ) -> None:
         if isinstance(element, str):
             self._enabled = False
@@ -255,6 +448,7 @@ class Button:
             self._enabled = True
             self.icon = icon
         self.driver = driver
+        self.limiter = limiter
 
     def __repr__(self):
         if self.icon is not None:
@@ -289,20 +483,35 @@ class Button:
             ico_ = ButtonIcon.MINUS
         self._icon = ico_
 
-    def click(self) -> None:
-        """Clicks the button, then registering to a class. """
-        if self.is_enabled():
+    def click(self) -> bool:
+        """Clicks the button, then registering to a class.
+
+        The button is clicked once, falling back to a click executed
+        from javascript if the element cannot be clicked.
+
+        Returns
+        -------
+        clicked : bool
+            True if the click reached the page, False otherwise.
+        """
+        if not self.is_enabled():
+            warnings.warn('The Button cannot be clicked.')
+            return False
+
+        if self.limiter is not None:
+            self.limiter.acquire(thr.Lane.BOOKING)
+        try:
+            self.element.click()
+        except WebDriverException:
+            logging.info("The button could not be clicked, trying to execute the element.")
             try:
-                self.element.click()
-                logging.info("Class booked!")
-            except:
-                logging.info("The button could not be clicked, trying to execute the element.")
                 self.driver.execute_script("arguments[0].click();", self.element)
-            finally:
+            except WebDriverException:
                 logging.info("Could not book the class")
+                return False
 
-        else:
-            warnings.warn('The Button cannot be clicked.')
+        logging.info("Class booked!")
+        return True
 
 
 class Activities:
@@ -338,9 +547,9 @@ class Activity:
         """
         # Check for space
         if self.reservation.is_free():
-            self.button.click()
-            logging.info('Class registered: {}'.format(self))
-            check = True
+            check = self.button.click()
+            if check:
+                logging.info('Class registered: {}'.format(self))
         else:
             logging.info('No space at the moment')
             check = False
@@ -390,3 +599,111 @@ class Weightlifting(Activity):
     @property
     def name(self) -> str:
         return Activities.WEIGHTLIFTING
+
+
+ACTIVITY_CLASSES = {
+    Activities.OPEN_BOX: OpenBox,
+    Activities.CROSSFIT: Crossfit,
+    Activities.CALISTHENICS: Calisthenics,
+    Activities.WEIGHTLIFTING: Weightlifting,
+}
+
+
+class ActivityTable:
+    """Table of activities of a day, parsed in bulk by columns.
+
+    The Activity objects are only created for the rows asked, see activity.
+
+    Parameters
+    ----------
+    rows : list of list
+        Each row of the table as [schedule, name, reservation, text, link, icon, registered]:
+        the text of the first three cells and of the last one, the element to
+        click in the last cell (or None), the class of its icon (or None), and
+        whether the row has the extra cell of the classes already registered.
+    driver : WebDriver
+        Driver the elements belong to.
+    limiter : thr.RateLimiter or None
+        Rate limiter passed to the buttons.
+
+    Attributes
+    ----------
+    names
+    schedules
+    reservations
+    bookable
+    registered
+
+    Examples
+    --------
+    >>> link = object()  # WebElement of the button, as returned by the driver.
+    >>> table = ActivityTable([
+    ...     ['11:00 - 13:00', 'Open Box', '(13/15)', '', link, 'glyphicon-plus', False],
+    ...     ['19:00 - 20:00', 'Crossfit', '(14/15)', '', link, 'glyphicon-minus', True],
+    ... ], None)
+    >>> table.matching(['Open Box'], Hour('11:30'))
+    [0]
+    >>> table.matching(['Open Box'], Hour('11:00'))
+    [0]
+    >>> list(table.bookable), list(table.registered)
+    ([1, 0], [0, 1])
+    >>> table.activity(0)
+    OpenBox(11:00 - 13:00, (13/15))
+    """
+    def __init__(
+            self,
+            rows: typing.List[typing.List],
+            driver: "WebDriver",
+            limiter: typing.Union[thr.RateLimiter, None] = None
+    ) -> None:
+        self._rows = rows
+        self.driver = driver
+        self.limiter = limiter
+        columns = list(zip(*rows)) if len(rows) > 0 else [()] * 7
+        self.names = columns[1]
+        self.schedules = parse_schedules(columns[0])
+        self.reservations = parse_reservations(columns[2])
+        # Rows well formatted, with a place and a button to book it. A minus icon would leave the reservation.
+        self.bookable = bytes(
+            valid and free and not text and link is not None and icon is not None and 'plus' in icon and not extra
+            for valid, free, text, link, icon, extra in zip(
+                self.schedules.valid, self.reservations.free, columns[3], columns[4], columns[5], columns[6]
+            )
+        )
+        # Rows already booked, with the extra cell or a button that would leave the reservation.
+        self.registered = bytes(
+            extra or (icon is not None and 'minus' in icon) for icon, extra in zip(columns[5], columns[6])
+        )
+
+    def __repr__(self):
+        return '{}({} rows, {} bookable)'.format(self.__class__.__name__, len(self), sum(self.bookable))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def matching(self, classes: typing.List[str], hour: Hour) -> typing.List[int]:
+        """Rows of any of the classes whose schedule contains hour. """
+        contains = self.schedules.containing(hour)
+        return [i for i, name in enumerate(self.names) if contains[i] and name in classes]
+
+    def find(self, schedule: str, name: str) -> typing.List[int]:
+        """Rows of a class with the given schedule, as written in the table. """
+        return [i for i, row in enumerate(self._rows) if row[0] == schedule and row[1] == name]
+
+    def start(self, i: int) -> Hour:
+        """Start hour of a row. """
+        return Hour.from_minutes(self.schedules.start[i])
+
+    def activity(self, i: int) -> typing.Union[Activity, None]:
+        """Creates the Activity of a row, or None if the activity is not registered. """
+        schedule, name, reservation, text, link, icon, _ = self._rows[i]
+        if name not in ACTIVITY_CLASSES:
+            warnings.warn('Activity unregistered: {}.'.format(name))
+            return None
+        if text or link is None or icon is None:
+            button = Button(text, self.driver, limiter=self.limiter)
+        else:
+            button = Button(link, self.driver, icon=icon, limiter=self.limiter)
+        return ACTIVITY_CLASSES[name](
+            schedule=Schedule(schedule), reservation=Reservation(reservation), button=button
+        )
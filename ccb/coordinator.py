@@ -0,0 +1,512 @@
+"""
+Distributed polling of several accounts and days.
+
+A coordinator process holds the config files of the accounts and assigns
+each (account, day) target to one of the worker nodes. Each worker drives
+its browsers through a Remote WebDriver (a selenium grid, or a local
+standalone server as a stand-in), and reports the bookings back to the
+coordinator, which collects the results. When a worker stops sending
+heartbeats, its days are assigned to the rest of the workers.
+
+Start the coordinator with the config files of the accounts:
+    python ccb/coordinator.py serve ccb/config.json other.json --authkey secret
+
+And one or more workers, on any machine reaching the coordinator:
+    python ccb/coordinator.py work --address host:50000 --authkey secret --remote http://localhost:4444/wd/hub
+
+The config files are sent to the workers through the connection of the
+manager, which authenticates the clients with the authkey but doesn't
+encrypt the traffic. Use it inside a trusted network. The coordinator only
+listens on localhost by default, pass --address host:50000 with an address
+of the trusted network to reach workers on other machines.
+"""
+
+import argparse
+import collections
+import datetime as dt
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import typing
+import uuid
+from multiprocessing.managers import BaseManager
+
+from selenium.common.exceptions import WebDriverException
+
+
+# Set default message from config to be info, and prettier format:
+logging.basicConfig(format='%(asctime)s --> %(levelname)s: %(message)s', level=logging.INFO)
+
+
+up = os.path.dirname
+here = up(up(os.path.abspath(__file__)))
+if here not in sys.path:
+    sys.path.append(here)
+
+
+import ccb.main as ccb_main
+import ccb.throttle as thr
+
+DEFAULT_PORT = 50000
+HEARTBEAT_TIMEOUT = 60  # Seconds without heartbeat before a worker is taken as dropped.
+HEARTBEAT_INTERVAL = 10  # Seconds between heartbeats of a worker, well below HEARTBEAT_TIMEOUT.
+POLL_INTERVAL = 5  # Seconds between polls of a worker.
+
+
+class LoginError(RuntimeError):
+    def __init__(self, username, message="Login failed."):
+        self.username = username
+        self.message = message + " Account: {}.".format(username)
+        super().__init__(self.message)
+
+
+class Coordinator:
+    """Assigns the (account, day) targets of the config files to the workers.
+
+    The days are sent as strings in isoformat (yyyy-mm-dd), and the accounts
+    are the usernames of the config files.
+
+    Parameters
+    ----------
+    configs : list of dict
+        Contents of the config files of the accounts.
+    heartbeat_timeout : float
+        Seconds without heartbeat before a worker is taken as dropped.
+        Defaults to HEARTBEAT_TIMEOUT.
+    start : dt.date or None
+        First day of the targets, see JsonConfig.targets. Defaults to None, today.
+
+    Methods
+    -------
+    register
+    heartbeat
+    account
+    report
+    results
+    done
+
+    Examples
+    --------
+    The days of an account stay on one worker, the accounts are spread
+    between the workers:
+
+    >>> hours = {"11:00": ["Open Box"]}
+    >>> config_a = {"Username": "a", "Password": "*", "days": {"13/12/2020": hours, "14/12/2020": hours}}
+    >>> config_b = {"Username": "b", "Password": "*", "days": {"13/12/2020": hours}}
+    >>> coordinator = Coordinator([config_a, config_b], heartbeat_timeout=0.2, start=dt.date(2020, 12, 13))
+    >>> coordinator.register('worker-1')
+    >>> coordinator.register('worker-2')
+    >>> coordinator.heartbeat('worker-1')
+    [('a', '2020-12-13'), ('a', '2020-12-14')]
+    >>> coordinator.heartbeat('worker-2')
+    [('b', '2020-12-13')]
+
+    When worker-1 misses its heartbeats, its days go to worker-2:
+
+    >>> time.sleep(0.3)
+    >>> coordinator.heartbeat('worker-2')
+    [('a', '2020-12-13'), ('a', '2020-12-14'), ('b', '2020-12-13')]
+    >>> coordinator.heartbeat('worker-1')
+    []
+
+    Once every day is reported, the workers are told to stop:
+
+    >>> coordinator.report('worker-2', 'a', '2020-12-13', True)
+    >>> coordinator.report('worker-2', 'a', '2020-12-14', False)
+    >>> coordinator.report('worker-2', 'b', '2020-12-13', True)
+    >>> coordinator.done()
+    True
+    >>> coordinator.heartbeat('worker-2') is None
+    True
+    >>> coordinator.results()[('a', '2020-12-13')]
+    {'worker': 'worker-2', 'booked': True, 'error': None}
+    """
+    def __init__(
+            self,
+            configs: typing.List[typing.Dict],
+            heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+            start: typing.Union[dt.date, None] = None
+    ) -> None:
+        self._lock = threading.Lock()
+        self._timeout = heartbeat_timeout
+        self._accounts = {}
+        # Worker assigned to each pending (account, day), None if unassigned.
+        self._pending = collections.OrderedDict()
+        self._results = {}
+        self._workers = {}  # Last heartbeat of each worker.
+        for data in configs:
+            config = ccb_main.JsonConfig(None, data=data)
+            username, _ = config.submit_info()
+            self._accounts[username] = data
+            for day in sorted({target.day for target in config.targets(start)}):
+                self._pending[(username, day.isoformat())] = None
+
+    def __repr__(self):
+        return '{}(workers={}, pending={}, done={})'.format(
+            self.__class__.__name__, len(self._workers), len(self._pending), len(self._results)
+        )
+
+    def register(self, worker_id: str) -> None:
+        """Adds a worker to the pool, its targets are assigned on its heartbeats. """
+        with self._lock:
+            self._workers[worker_id] = time.monotonic()
+            logging.info('Worker registered: {}'.format(worker_id))
+
+    def heartbeat(self, worker_id: str) -> typing.Union[typing.List[typing.Tuple[str, str]], None]:
+        """Keeps the worker alive and returns its assignments.
+
+        Parameters
+        ----------
+        worker_id : str
+            Identifier of the worker.
+
+        Returns
+        -------
+        assignments : list of tuple or None
+            Pairs (account, day) the worker must poll, or None when
+            nothing is left to book and the worker can stop.
+        """
+        with self._lock:
+            if worker_id not in self._workers:
+                logging.info('Worker back: {}'.format(worker_id))
+            self._workers[worker_id] = time.monotonic()
+            self._rebalance()
+            if len(self._pending) == 0:
+                return None
+            return [key for key, worker in self._pending.items() if worker == worker_id]
+
+    def account(self, username: str) -> typing.Dict:
+        """Contents of the config file of an account. """
+        return self._accounts[username]
+
+    def report(
+            self, worker_id: str, username: str, day: str, booked: bool, error: typing.Union[str, None] = None
+    ) -> None:
+        """Collects the result of an (account, day) target, which is no longer polled.
+
+        Parameters
+        ----------
+        worker_id : str
+            Identifier of the worker reporting.
+        username : str
+            Account of the target.
+        day : str
+            Day of the target, in isoformat.
+        booked : bool
+            True if a class was booked, False if nothing was left to book.
+        error : str or None
+            Why the target could not be polled, i.e. a failed login.
+            Defaults to None.
+        """
+        with self._lock:
+            self._pending.pop((username, day), None)
+            self._results[(username, day)] = {'worker': worker_id, 'booked': booked, 'error': error}
+            logging.info('{} reported ({}, {}): booked {}'.format(worker_id, username, day, booked))
+
+    def results(self) -> typing.Dict[typing.Tuple[str, str], typing.Dict]:
+        """Results reported by the workers, by (account, day). """
+        with self._lock:
+            return dict(self._results)
+
+    def done(self) -> bool:
+        """Returns True when every target has been reported. """
+        with self._lock:
+            return len(self._pending) == 0
+
+    def _rebalance(self) -> None:
+        """Drops the workers without heartbeat and assigns their targets, and
+        the unassigned ones, to the least loaded workers. Must be called with the lock held.
+        """
+        now = time.monotonic()
+        for worker_id, last in list(self._workers.items()):
+            if now - last > self._timeout:
+                del self._workers[worker_id]
+                logging.info('Worker dropped: {}'.format(worker_id))
+
+        load = {worker_id: 0 for worker_id in self._workers}
+        for key, worker_id in self._pending.items():
+            if worker_id in load:
+                load[worker_id] += 1
+            else:
+                self._pending[key] = None
+
+        if len(load) == 0:
+            return
+        # The days of an account are kept together on one worker, to share its browser.
+        unassigned = collections.OrderedDict()
+        for key, worker_id in self._pending.items():
+            if worker_id is None:
+                unassigned.setdefault(key[0], []).append(key)
+        for username, keys in unassigned.items():
+            owner = next(
+                (w for (u, _), w in self._pending.items() if u == username and w is not None), None
+            )
+            if owner is None:
+                owner = min(load, key=load.get)
+            for key in keys:
+                self._pending[key] = owner
+                load[owner] += 1
+
+
+_COORDINATOR = None
+
+
+def _get_coordinator() -> Coordinator:
+    """Coordinator served by the manager. """
+    return _COORDINATOR
+
+
+class CoordinatorManager(BaseManager):
+    """Manager sharing the Coordinator with the workers. """
+
+
+CoordinatorManager.register('coordinator', callable=_get_coordinator)
+
+
+def _parse_address(address: str) -> typing.Tuple[str, int]:
+    """Creates an (host, port) tuple from a string of the format host:port. """
+    host, _, port = address.rpartition(':')
+    return host, int(port) if port else DEFAULT_PORT
+
+
+def serve(
+        configs: typing.List[typing.Dict],
+        address: typing.Tuple[str, int],
+        authkey: bytes,
+        heartbeat_timeout: float = HEARTBEAT_TIMEOUT
+) -> typing.Dict[typing.Tuple[str, str], typing.Dict]:
+    """Runs the coordinator until every target is reported.
+
+    Parameters
+    ----------
+    configs : list of dict
+        Contents of the config files of the accounts.
+    address : tuple
+        (host, port) to listen on.
+    authkey : bytes
+        Key the workers must use to connect.
+    heartbeat_timeout : float
+        Seconds without heartbeat before a worker is taken as dropped.
+
+    Returns
+    -------
+    results : dict
+        Results reported by the workers, by (account, day).
+    """
+    global _COORDINATOR
+    _COORDINATOR = Coordinator(configs, heartbeat_timeout=heartbeat_timeout)
+    manager = CoordinatorManager(address=address, authkey=authkey)
+    server = manager.get_server()
+    # The server runs in this process, so the coordinator can be checked here.
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info('Coordinator listening on {}: {}'.format(address, _COORDINATOR))
+
+    while not _COORDINATOR.done():
+        time.sleep(POLL_INTERVAL)
+    # Let the workers get the last heartbeat before closing.
+    time.sleep(HEARTBEAT_INTERVAL * 2)
+
+    results = _COORDINATOR.results()
+    for (username, day), result in results.items():
+        logging.info('({}, {}): {}'.format(username, day, result))
+    return results
+
+
+class _Heartbeat(threading.Thread):
+    """Sends the heartbeats of a worker apart from its polls, keeping the last assignments.
+
+    A poll of a worker takes longer the more accounts and days it has, all
+    behind its rate limiter, so the heartbeats can't wait for the polls or
+    the coordinator would take a live worker as dropped and give its days
+    to another one.
+    """
+    def __init__(self, coordinator, worker_id: str, interval: float = HEARTBEAT_INTERVAL) -> None:
+        super().__init__(daemon=True)
+        self._coordinator = coordinator
+        self._worker_id = worker_id
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._received = threading.Event()
+        self._assignments = []
+        self.error = None
+
+    def run(self) -> None:
+        while True:
+            try:
+                assignments = self._coordinator.heartbeat(self._worker_id)
+            except Exception as e:
+                # The coordinator is lost, the worker stops with the error.
+                self.error = e
+                assignments = None
+            with self._lock:
+                self._assignments = assignments
+            self._received.set()
+            if assignments is None or self._stop_event.wait(self._interval):
+                break
+
+    @property
+    def assignments(self) -> typing.Union[typing.List[typing.Tuple[str, str]], None]:
+        """Assignments of the last heartbeat, waiting for the first one. None when the worker must stop. """
+        self._received.wait()
+        with self._lock:
+            return self._assignments
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+class _Browser:
+    """Browser of a worker for one account, with a tab per assigned day. """
+    def __init__(
+            self, data: typing.Dict, remote_url: typing.Union[str, None], limiter: thr.RateLimiter
+    ) -> None:
+        self.config = ccb_main.JsonConfig(None, data=data)
+        self.ccb = ccb_main.CCB(limiter=limiter, remote_url=remote_url)
+        username, password = self.config.submit_info()
+        try:
+            self.ccb.login(username, password, fast=ccb_main.FAST_LOGIN)
+        except WebDriverException as e:
+            # The session of the Remote WebDriver is ended, it would take a node of the grid.
+            self.ccb.close_page()
+            raise LoginError(username) from e
+        self.targets = []
+
+    def assign(self, days: typing.Set[dt.date]) -> None:
+        """Polls from now on the given days, and only those. """
+        current = {target.day for target in self.targets}
+        for day in current - days:
+            self.ccb.close_day(day)
+        self.targets = [target for target in self.targets if target.day in days]
+        # The expired targets are pruned before opening their tabs.
+        new = ccb_main.prune_targets([target for target in self.config.targets() if target.day in days - current])
+        self.targets.extend(new)
+        self.ccb.open_days(sorted({target.day for target in new}))
+
+
+def work(
+        address: typing.Tuple[str, int],
+        authkey: bytes,
+        remote_url: typing.Union[str, None] = None,
+        worker_id: typing.Union[str, None] = None,
+        rate: float = ccb_main.RATE_LIMIT,
+        burst: float = ccb_main.RATE_BURST
+) -> None:
+    """Runs a worker until the coordinator has nothing left to book.
+
+    Every browser of the worker shares the same rate limiter. The bucket
+    lives in the memory of the worker, so the budget is per worker (per
+    machine when running one worker per machine), it cannot be shared
+    with the workers of other hosts.
+
+    The heartbeats are sent by a thread every HEARTBEAT_INTERVAL, apart from
+    the polls, so the days of the worker are only assigned to another one
+    when it stops or loses the coordinator, however long its polls take.
+
+    Parameters
+    ----------
+    address : tuple
+        (host, port) of the coordinator.
+    authkey : bytes
+        Key of the coordinator.
+    remote_url : str or None
+        Endpoint of the Remote WebDriver. Defaults to None, a local chromedriver.
+    worker_id : str or None
+        Identifier of the worker. Defaults to None, generated from the hostname.
+    rate : float
+        Requests per second allowed to the worker. Defaults to RATE_LIMIT.
+    burst : float
+        Requests allowed in a burst to the worker. Defaults to RATE_BURST.
+    """
+    if worker_id is None:
+        worker_id = '{}-{}'.format(socket.gethostname(), uuid.uuid4().hex[:6])
+    manager = CoordinatorManager(address=address, authkey=authkey)
+    manager.connect()
+    coordinator = manager.coordinator()
+    coordinator.register(worker_id)
+    limiter = thr.RateLimiter(rate=rate, capacity=burst)
+    heartbeat = _Heartbeat(coordinator, worker_id)
+    heartbeat.start()
+
+    browsers = {}
+    try:
+        while True:
+            assignments = heartbeat.assignments
+            if assignments is None:
+                if heartbeat.error is not None:
+                    raise heartbeat.error
+                break
+
+            days = collections.defaultdict(set)
+            for username, day in assignments:
+                days[username].add(dt.date.fromisoformat(day))
+            for username in set(browsers) - set(days):
+                browsers.pop(username).ccb.close_page()
+
+            for username, account_days in days.items():
+                if username not in browsers:
+                    try:
+                        browsers[username] = _Browser(coordinator.account(username), remote_url, limiter)
+                    except LoginError as e:
+                        # Other workers would fail the same way, the days are reported for the coordinator to finish.
+                        logging.error(e.message)
+                        for day in account_days:
+                            coordinator.report(worker_id, username, day.isoformat(), False, error=e.message)
+                        continue
+                browser = browsers[username]
+                browser.assign(account_days)
+                if len(browser.targets) > 0:
+                    browser.targets, booked = ccb_main.poll_once(browser.ccb, browser.targets)
+                else:
+                    booked = []
+
+                booked_days = {target.day for target in booked}
+                left = {target.day for target in browser.targets}
+                for day in account_days - left:
+                    coordinator.report(worker_id, username, day.isoformat(), day in booked_days)
+
+            logging.info('Rate limiter queueing: {}'.format(limiter.stats()))
+            time.sleep(POLL_INTERVAL)
+    finally:
+        heartbeat.stop()
+        for browser in browsers.values():
+            browser.ccb.close_page()
+    logging.info('Worker finished: {}'.format(worker_id))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Distributed polling of several accounts and days.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='Run the coordinator.')
+    serve_parser.add_argument('configs', nargs='+', help='Config files of the accounts.')
+    serve_parser.add_argument('--address', default='localhost:{}'.format(DEFAULT_PORT), help='host:port to listen on.')
+    serve_parser.add_argument('--authkey', required=True, help='Key the workers must use to connect.')
+    serve_parser.add_argument('--timeout', type=float, default=HEARTBEAT_TIMEOUT, help='Heartbeat timeout in secs.')
+
+    work_parser = subparsers.add_parser('work', help='Run a worker.')
+    work_parser.add_argument('--address', default='localhost:{}'.format(DEFAULT_PORT), help='host:port of the coordinator.')
+    work_parser.add_argument('--authkey', required=True, help='Key of the coordinator.')
+    work_parser.add_argument('--remote', default=None, help='Remote WebDriver endpoint.')
+    work_parser.add_argument('--id', default=None, help='Identifier of the worker.')
+    work_parser.add_argument('--rate', type=float, default=ccb_main.RATE_LIMIT, help='Requests per second of the worker.')
+    work_parser.add_argument('--burst', type=float, default=ccb_main.RATE_BURST, help='Requests in a burst of the worker.')
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        configs = []
+        for path in args.configs:
+            with open(path) as f:
+                configs.append(json.load(f))
+        serve(configs, _parse_address(args.address), args.authkey.encode(), heartbeat_timeout=args.timeout)
+    else:
+        work(
+            _parse_address(args.address), args.authkey.encode(), remote_url=args.remote, worker_id=args.id,
+            rate=args.rate, burst=args.burst
+        )
@@ -15,12 +15,15 @@ import datetime as dt
 import typing
 import os
 import sys
-import warnings
 import json
+import heapq
+import argparse
 
 import selenium.webdriver as wd
 from selenium.webdriver.common.by import By
-import selenium.webdriver.remote.webelement as we
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException, WebDriverException
 
 # Set default message from config to be info, and prettier format:
 logging.basicConfig(format='%(asctime)s --> %(levelname)s: %(message)s', level=logging.INFO)
@@ -34,9 +37,17 @@ if here not in sys.path:
 
 # from . import activities as act
 import ccb.activities as act
+import ccb.throttle as thr
+import ccb.profiling as prof
 # from ccb import activities as act
 
 WAIT_FOR_CLOSE = 5  # Wait 5 seconds before closing the page.
+LOGIN_TIMEOUT = 10  # Max seconds waiting for the calendar after the login.
+CONFIRM_TIMEOUT = 5  # Max seconds waiting for a booking to show in the table.
+FAST_LOGIN = True  # Login with a single scripted submit, see CCB.fast_login.
+LOOK_AHEAD_DAYS = 7  # Days ahead to expand the recurring rules of the config file.
+RATE_LIMIT = 0.5  # Requests per second allowed to the page.
+RATE_BURST = 5  # Requests allowed in a burst.
 
 
 # 1) acceso clientes:
@@ -44,6 +55,36 @@ URL = r'https://www.crossfitcostablanca.es/acceso-a-clientes/'
 # 2) login:
 LOGIN_URL = r'https://www.crossfitcostablanca.es/login.php'
 
+# Reads the rows of the table of activities in a single call, see CCB.get_table.
+TABLE_SCRIPT = """
+var tables = document.getElementsByClassName('table-striped');
+if (tables.length < 2) { return []; }
+var rows = tables[1].getElementsByTagName('tr');
+var out = [];
+for (var i = 2; i < rows.length; i++) {
+    var cells = rows[i].getElementsByTagName('td');
+    if (cells.length < 4) { continue; }
+    // The rows of the classes already registered have an extra cell, the button is the last one.
+    var button = cells[cells.length - 1];
+    var link = button.querySelector('a');
+    var icon = button.querySelector('span');
+    out.push([
+        cells[0].innerText.trim(), cells[1].innerText.trim(), cells[2].innerText.trim(),
+        button.innerText.trim(), link, icon ? icon.getAttribute('class') : null, cells.length > 4
+    ]);
+}
+return out;
+"""
+
+# Fills and submits the login form in a single call, arguments are the username and password.
+LOGIN_SCRIPT = """
+var form = document.getElementsByName('Email')[0].form;
+form.elements['Email'].value = arguments[0];
+form.elements['passwd'].value = arguments[1];
+var button = form.querySelector('.btn-primary');
+if (button) { button.click(); } else { form.submit(); }
+"""
+
 
 CLASS_MAP = {
     'Open Box': act.Activities.OPEN_BOX,
@@ -67,6 +108,322 @@ class NoHoursError(ValueError):
         super().__init__(self.message)
 
 
+class RuleError(ValueError):
+    def __init__(self, rule, message="Bad recurring rule."):
+        self.rule = rule
+        self.message = message + " Rule: {}.".format(rule)
+        super().__init__(self.message)
+
+
+WEEKDAYS = {'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5, 'sun': 6}
+
+
+def _parse_day(day: str) -> dt.date:
+    """Creates a dt.date object from a string of the format dd/mm/yyyy. """
+    try:
+        d, m, y = day.split('/')
+        return dt.date(int(y), int(m), int(d))
+    except ValueError:
+        raise ValueError("Bad day format in 'wanted_days'. ")
+
+
+def _parse_cutoff(minutes: typing.Union[int, float]) -> dt.timedelta:
+    """Creates a dt.timedelta object from the minutes of a cancellation cutoff. """
+    if not isinstance(minutes, (int, float)) or minutes < 0:
+        raise ValueError("Bad cutoff, must be a positive number of minutes: {}. ".format(minutes))
+    return dt.timedelta(minutes=minutes)
+
+
+def _parse_classes(classes: typing.List[str]) -> typing.List[str]:
+    """Parse the class strings to the ones defined in Activities. """
+    parsed = []
+    for wanted_class in classes:
+        if wanted_class not in CLASS_MAP.keys():
+            raise ClassError(wanted_class)
+        parsed.append(CLASS_MAP[wanted_class])
+    return parsed
+
+
+class Target:
+    """A class wanted to be booked: the day, the hour and the classes
+    accepted at that hour.
+
+    The target expires at its deadline, the start of the class minus the
+    cancellation cutoff. Until the class is found in the table of the day,
+    the wanted hour is taken as the start.
+
+    Parameters
+    ----------
+    day : dt.date
+        Day of the class.
+    hour : act.Hour
+        Hour wanted, must be contained in the schedule of the class.
+    classes : list of str
+        Classes accepted, as defined in act.Activities.
+    cutoff : dt.timedelta or None
+        Time before the start of the class after which it can no longer
+        be booked. Defaults to None, the class can be booked until it starts.
+    priority : int
+        Priority of the target when several classes are free on the same
+        day, the lower the preferred. Defaults to 0.
+
+    Examples
+    --------
+    >>> target = Target(dt.date(2020, 11, 23), act.Hour('11:30'), ['Open Box'])
+    >>> target
+    Target(2020-11-23, 11:30, ['Open Box'])
+    >>> target.deadline
+    datetime.datetime(2020, 11, 23, 11, 30)
+    >>> target.update_deadline(act.Hour('11:00'))
+    >>> target.deadline
+    datetime.datetime(2020, 11, 23, 11, 0)
+    """
+    def __init__(
+            self,
+            day: dt.date,
+            hour: act.Hour,
+            classes: typing.List[str],
+            cutoff: typing.Union[dt.timedelta, None] = None,
+            priority: int = 0
+    ) -> None:
+        self.day = day
+        self.hour = hour
+        self.classes = classes
+        self.priority = priority
+        self.cutoff = cutoff if cutoff is not None else dt.timedelta(0)
+        self.deadline = dt.datetime.combine(day, hour.to_time()) - self.cutoff
+
+    def __repr__(self):
+        return '{}({}, {}, {})'.format(self.__class__.__name__, self.day, self.hour, self.classes)
+
+    def __str__(self):
+        return self.__repr__()
+
+    def matches(self, activity: act.Activity) -> bool:
+        """Checks whether an activity of the day of the target is the wanted one. """
+        return activity.name in self.classes and self.hour in activity.schedule
+
+    def update_deadline(self, start: act.Hour) -> None:
+        """Sets the deadline from the start of the class found in the table. """
+        self.deadline = dt.datetime.combine(self.day, start.to_time()) - self.cutoff
+
+    def is_expired(self, now: typing.Union[dt.datetime, None] = None) -> bool:
+        """Returns True if the deadline of the target has passed.
+
+        Parameters
+        ----------
+        now : dt.datetime or None
+            Time to compare with. Defaults to None, the current time.
+        """
+        if now is None:
+            now = dt.datetime.now()
+        return now >= self.deadline
+
+
+class Candidate:
+    """A free activity in the table of a day matching a target.
+
+    Parameters
+    ----------
+    target : Target
+        Target matched by the activity.
+    activity : act.Activity
+        Activity with a free place.
+    """
+    def __init__(self, target: Target, activity: act.Activity) -> None:
+        self.target = target
+        self.activity = activity
+
+    def __repr__(self):
+        return '{}({}, {})'.format(self.__class__.__name__, self.target, self.activity)
+
+    @property
+    def day(self) -> dt.date:
+        """Day of the activity. """
+        return self.target.day
+
+    @property
+    def rank(self) -> typing.Tuple[int, int, dt.datetime]:
+        """Sorting key, the lower the preferred: the priority of the target,
+        the position of the class in the classes of the target, and the
+        earliest class first.
+        """
+        return self.target.priority, self.target.classes.index(self.activity.name), self.target.deadline
+
+
+def decide(candidates: typing.List[Candidate]) -> typing.List[Candidate]:
+    """Ranks the candidates of every day and keeps the best one of each day.
+
+    Only one class is booked per day, so the rest are conflicting bookings.
+
+    Parameters
+    ----------
+    candidates : list of Candidate
+        Free activities found in a poll.
+
+    Returns
+    -------
+    candidates : list of Candidate
+        Candidates to book, the preferred first.
+    """
+    chosen = []
+    days = set()
+    for candidate in sorted(candidates, key=lambda c: c.rank):
+        if candidate.day in days:
+            logging.info('Skipped, lower priority: {}'.format(candidate))
+            continue
+        days.add(candidate.day)
+        chosen.append(candidate)
+    return chosen
+
+
+def prune_targets(
+        targets: typing.List[Target], now: typing.Union[dt.datetime, None] = None
+) -> typing.List[Target]:
+    """Removes the targets whose deadline has passed.
+
+    Parameters
+    ----------
+    targets : list of Target
+        Work set of the poll loop.
+    now : dt.datetime or None
+        Time to compare with. Defaults to None, the current time.
+
+    Returns
+    -------
+    targets : list of Target
+        Targets that can still be booked.
+    """
+    alive = []
+    for target in targets:
+        if target.is_expired(now):
+            logging.info('Target expired, no longer checked: {}'.format(target))
+        else:
+            alive.append(target)
+    return alive
+
+
+class RecurringRule:
+    """Classes wanted every week on a set of weekdays.
+
+    The rule is never expanded as a whole, the days are generated
+    lazily for the window asked.
+
+    Parameters
+    ----------
+    weekdays : list of int
+        Days of the week, Monday is 0 and Sunday is 6.
+    hours : list of tuple
+        Pairs of each hour (act.Hour) and the classes accepted (list of str).
+    start : dt.date or None
+        First day of the rule. Defaults to None, no lower bound.
+    until : dt.date or None
+        Last day of the rule. Defaults to None, no upper bound.
+    exclude : list of dt.date
+        Days skipped, i.e. holidays.
+    cutoff : dt.timedelta or None
+        Cancellation cutoff of the targets of the rule, see Target.
+    priority : int
+        Priority of the targets of the rule, see Target. Defaults to 0.
+
+    Examples
+    --------
+    >>> rule = RecurringRule.from_dict(
+    ...     {"weekdays": ["Mon", "Wed", "Fri"], "hours": {"11:00": ["Open Box"]}, "except": ["25/11/2020"]}
+    ... )
+    >>> list(rule.dates(dt.date(2020, 11, 23), dt.date(2020, 11, 29)))
+    [datetime.date(2020, 11, 23), datetime.date(2020, 11, 27)]
+    """
+    def __init__(
+            self,
+            weekdays: typing.List[int],
+            hours: typing.List[typing.Tuple[act.Hour, typing.List[str]]],
+            start: typing.Union[dt.date, None] = None,
+            until: typing.Union[dt.date, None] = None,
+            exclude: typing.Union[typing.List[dt.date], None] = None,
+            cutoff: typing.Union[dt.timedelta, None] = None,
+            priority: int = 0
+    ) -> None:
+        self.weekdays = frozenset(weekdays)
+        self.hours = hours
+        self.start = start
+        self.until = until
+        self.exclude = frozenset(exclude or [])
+        self.cutoff = cutoff
+        self.priority = priority
+
+    def __repr__(self):
+        return '{}({}, {})'.format(self.__class__.__name__, sorted(self.weekdays), [str(hour) for hour, _ in self.hours])
+
+    @classmethod
+    def from_dict(cls, rule: typing.Dict, cutoff: typing.Union[dt.timedelta, None] = None) -> 'RecurringRule':
+        """Creates a rule from its definition in the config file.
+
+        Parameters
+        ----------
+        rule : dict
+            Must contain "weekdays" (names like "Mon" or numbers from 0 to 6)
+            and "hours" (same structure as an entry of "days"). May contain
+            "from" and "until" (dd/mm/yyyy), "except" (list of dd/mm/yyyy),
+            "cutoff" (minutes) and "priority" (int, the lower the preferred).
+        cutoff : dt.timedelta or None
+            Cutoff used when the rule doesn't define its own.
+
+        Returns
+        -------
+        rule : RecurringRule
+        """
+        try:
+            weekdays = [cls._parse_weekday(wd_) for wd_ in rule['weekdays']]
+            hours = [(act.Hour(hour), _parse_classes(classes)) for hour, classes in rule['hours'].items()]
+            start = _parse_day(rule['from']) if 'from' in rule else None
+            until = _parse_day(rule['until']) if 'until' in rule else None
+            exclude = [_parse_day(day) for day in rule.get('except', [])]
+        except (KeyError, AttributeError, TypeError, ValueError) as e:
+            if isinstance(e, ClassError):
+                raise
+            raise RuleError(rule)
+        if len(weekdays) == 0 or len(hours) == 0:
+            raise RuleError(rule, message="No weekdays or hours in recurring rule.")
+
+        if 'cutoff' in rule:
+            cutoff = _parse_cutoff(rule['cutoff'])
+        priority = rule.get('priority', 0)
+        if not isinstance(priority, int):
+            raise RuleError(rule, message="Priority must be an int.")
+        return cls(
+            weekdays, hours, start=start, until=until, exclude=exclude, cutoff=cutoff, priority=priority
+        )
+
+    @staticmethod
+    def _parse_weekday(weekday: typing.Union[str, int]) -> int:
+        """Weekday as an int, Monday is 0 and Sunday is 6. """
+        if isinstance(weekday, int):
+            if not 0 <= weekday <= 6:
+                raise ValueError('Weekday out of range: {}'.format(weekday))
+            return weekday
+        return WEEKDAYS[weekday[:3].lower()]
+
+    def dates(self, start: dt.date, end: dt.date) -> typing.Iterator[dt.date]:
+        """Generates the days of the rule between start and end, both included. """
+        if self.start is not None:
+            start = max(start, self.start)
+        if self.until is not None:
+            end = min(end, self.until)
+        day = start
+        one_day = dt.timedelta(days=1)
+        while day <= end:
+            if day.weekday() in self.weekdays and day not in self.exclude:
+                yield day
+            day += one_day
+
+    def targets(self, start: dt.date, end: dt.date) -> typing.Iterator[Target]:
+        """Generates the targets of the rule between start and end, both included. """
+        for day in self.dates(start, end):
+            for hour, classes in self.hours:
+                yield Target(day, hour, classes, cutoff=self.cutoff, priority=self.priority)
+
+
 class JsonConfig:
     """
     Sample config file:
@@ -77,7 +434,17 @@ class JsonConfig:
         "22/11/2020": {
             "11:00": ["Open Box", "Crossfit"]
         }
-    }
+    },
+    "recurring": [
+        {
+            "weekdays": ["Mon", "Wed", "Fri"],
+            "hours": {"11:00": ["Open Box"]},
+            "from": "01/12/2020",
+            "until": "31/01/2021",
+            "except": ["25/12/2020"]
+        }
+    ],
+    "cutoff": 30
     }
 
     Must contain 5 elements:
@@ -91,10 +458,22 @@ class JsonConfig:
         - wanted_days : list of days you are interested to check for the
         classes. Must be in format dd/mm/yyyy
 
+    Optionally, "recurring" contains a list of rules for classes repeated every
+    week, see RecurringRule.from_dict. They are expanded lazily by targets,
+    only for the days inside the look-ahead horizon.
+    Optionally, "cutoff" contains the minutes before the start of a class
+    after which it can no longer be booked, for every day and rule.
+    When several classes are free on the same day, the one booked is chosen by
+    the "priority" of the rule (the days have priority 0, the lower the preferred),
+    then by the order of the classes in their list, then the earliest.
+
     Parameters
     ----------
-    path : str
+    path : str or None
         Full path to json config file.
+    data : dict or None
+        Contents of the config file, already loaded. When given,
+        path is not read. Defaults to None.
 
     Examples
     --------
@@ -105,14 +484,18 @@ class JsonConfig:
     [datetime.date(2020, 11, 22)]
     >>> config.wanted_hours()
     [Hour(11:00)]
+    >>> list(config.targets(dt.date(2020, 11, 22), horizon=0))
+    [Target(2020-11-22, 11:00, ['Open Box', 'Crossfit'])]
     """
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: typing.Union[str, None], data: typing.Union[typing.Dict, None] = None) -> None:
         self._path = path
-        self._data = None
-        self._read_file()
+        self._data = data
+        if self._data is None:
+            self._read_file()
         self._classes = []
         self._hours = []
         self._days = []
+        self._rules = None
 
     def _read_file(self) -> None:
         """Parses the json config file and stores the info in _data attribute. """
@@ -124,15 +507,11 @@ class JsonConfig:
         Parse the class string to one defined in Activities, which are present in
         the page.
         """
-        for day in self._data["days"]:
+        for day in self._data.get("days", {}):
             self._days.append(self._parse_day(day))
             for hour in self._data["days"][day]:
                 self._hours.append(act.Hour(hour))
-                for wanted_class in self._data["days"][day][hour]:
-                    if wanted_class not in CLASS_MAP.keys():
-                        raise ClassError(wanted_class)
-                    activity = CLASS_MAP[wanted_class]
-                    self._classes.append(activity)
+                self._classes.extend(_parse_classes(self._data["days"][day][hour]))
 
     def submit_info(self) -> typing.Tuple[str, str]:
         """Returns a tuple with the username and password. """
@@ -161,14 +540,56 @@ class JsonConfig:
 
         return self._days
 
+    def cutoff(self) -> typing.Union[dt.timedelta, None]:
+        """Cancellation cutoff of the classes, or None if not defined. """
+        if "cutoff" not in self._data:
+            return None
+        return _parse_cutoff(self._data["cutoff"])
+
+    def rules(self) -> typing.List[RecurringRule]:
+        """Recurring rules defined in the config file. """
+        if self._rules is None:
+            self._rules = [
+                RecurringRule.from_dict(rule, cutoff=self.cutoff()) for rule in self._data.get("recurring", [])
+            ]
+        return self._rules
+
+    def targets(
+            self, start: typing.Union[dt.date, None] = None, horizon: int = LOOK_AHEAD_DAYS
+    ) -> typing.Iterator[Target]:
+        """Generates the targets of the config file, sorted by day, from the
+        literal days and the recurring rules.
+
+        Parameters
+        ----------
+        start : dt.date or None
+            First day to consider. Defaults to None, today.
+        horizon : int
+            Number of days ahead of start to consider. Defaults to LOOK_AHEAD_DAYS.
+
+        Returns
+        -------
+        targets : iterator of Target
+        """
+        if start is None:
+            start = dt.date.today()
+        end = start + dt.timedelta(days=horizon)
+
+        literal = []
+        for day, hours in self._data.get("days", {}).items():
+            date = self._parse_day(day)
+            if start <= date <= end:
+                for hour, classes in hours.items():
+                    literal.append(Target(date, act.Hour(hour), _parse_classes(classes), cutoff=self.cutoff()))
+        literal.sort(key=lambda t: t.day)
+
+        generators = [literal] + [rule.targets(start, end) for rule in self.rules()]
+        return heapq.merge(*generators, key=lambda t: t.day)
+
     @staticmethod
     def _parse_day(day: str) -> dt.date:
         """Creates a dt.date object. """
-        try:
-            d, m, y = day.split('/')
-            return dt.date(int(y), int(m), int(d))
-        except ValueError:
-            raise ValueError("Bad day format in 'wanted_days'. ")
+        return _parse_day(day)
 
 
 class CCB:
@@ -179,44 +600,146 @@ class CCB:
     webdriver_ : webdriver
         webdriver to use from selenium. Defaults to Chrome.
         Only one tested.
+    limiter : thr.RateLimiter or None
+        Rate limiter shared by every request sent to the page (navigation,
+        refresh and booking). Pass the same instance to every CCB to share
+        the budget across threads and processes. Defaults to None, no limit.
+    remote_url : str or None
+        Endpoint of a Remote WebDriver, i.e. a selenium grid:
+        http://localhost:4444/wd/hub. Defaults to None, a local chromedriver.
+    driver_path : str or None
+        Path to the local chromedriver. Defaults to None, the chromedriver.exe
+        of the project.
 
     Methods
     -------
+    login
+    fast_login
     login_page
     set_username
     set_password
     submit
+    open_days
+    switch_to_day
+    poll_days
 
     """
-    def __init__(self, webdriver_: str = 'chrome') -> None:
+    def __init__(
+            self,
+            webdriver_: str = 'chrome',
+            limiter: typing.Union[thr.RateLimiter, None] = None,
+            remote_url: typing.Union[str, None] = None,
+            driver_path: typing.Union[str, None] = None
+    ) -> None:
+        self.remote_url = remote_url
+        self.driver_path = driver_path
         self.driver = webdriver_
+        self.limiter = limiter
+        # Window handle of the tab opened for each wanted day.
+        self._tabs = {}
 
     @property
-    def driver(self) -> wd.Chrome:
+    def driver(self) -> typing.Union[wd.Chrome, wd.Remote]:
         """WebDriver object from selenium. Interactive web page object."""
         return self._driver
 
     @driver.setter
     def driver(self, drv: str) -> None:
         if drv.lower() == 'chrome':
-            # Get the path to the chromedriver.exe of the project.
-            driver_path = os.path.join(here, 'ccb', 'chromedriver.exe')
-            logging.info(driver_path)
-
             # Set headless mode to avoid opening the browser
             options = wd.ChromeOptions()
             options.add_argument('headless')
 
-            self._driver = wd.Chrome(driver_path)
-            # self._driver = wd.Chrome(driver_path, options=options)
+            if self.remote_url is not None:
+                # The nodes of the grid have no one looking at the browser.
+                self._driver = wd.Remote(
+                    command_executor=self.remote_url, desired_capabilities=options.to_capabilities()
+                )
+                logging.info('Remote WebDriver: {}'.format(self.remote_url))
+            else:
+                # Get the path to the chromedriver.exe of the project.
+                driver_path = self.driver_path or os.path.join(here, 'ccb', 'chromedriver.exe')
+                logging.info(driver_path)
+
+                self._driver = wd.Chrome(driver_path)
+                # self._driver = wd.Chrome(driver_path, options=options)
             self._driver.maximize_window()
         else:
             raise NotImplementedError(
                 "Only tested for 'chrome', implement yourself other driver."
             )
 
+    def _throttle(self, lane: str) -> None:
+        """Waits for the rate limiter, if any, before sending a request to the page. """
+        if self.limiter is not None:
+            self.limiter.acquire(lane)
+
+    def login(self, username: str, password: str, fast: bool = False) -> None:
+        """Enters to the login page and gets logged in, leaving the
+        calendar on the current tab.
+
+        Parameters
+        ----------
+        username : str
+            Username to be passed to submit.
+        password : str
+            Password to be passed to submit.
+        fast : bool
+            Whether to use fast_login instead of waiting fixed times
+            around submit. Defaults to False.
+        """
+        if fast:
+            self.fast_login(username, password)
+            return
+
+        self.login_page()
+        # Wait 2 seconds in case the time is needed to load the page.
+        time.sleep(2)
+        self.submit(username, password)
+        time.sleep(WAIT_FOR_CLOSE)
+
+    def fast_login(self, username: str, password: str, timeout: float = LOGIN_TIMEOUT) -> float:
+        """Enters to the login page, fills and submits the form with a single
+        script, and waits until the calendar table is present.
+
+        Parameters
+        ----------
+        username : str
+            Username.
+        password : str
+            Password.
+        timeout : float
+            Max seconds waiting for the calendar. Defaults to LOGIN_TIMEOUT.
+
+        Returns
+        -------
+        latency : float
+            Seconds from the request of the login page to the calendar.
+
+        Raises
+        ------
+        TimeoutException
+            If the calendar is not found in time, i.e. wrong username or password.
+        """
+        start = time.time()
+        # get returns once the page is loaded, no need to wait.
+        self.login_page()
+        self._throttle(thr.Lane.NAVIGATION)
+        self.driver.execute_script(LOGIN_SCRIPT, username, password)
+        try:
+            WebDriverWait(self.driver, timeout, poll_frequency=0.05).until(
+                EC.presence_of_element_located((By.CLASS_NAME, 'table-striped'))
+            )
+        except TimeoutException:
+            logging.error('Calendar not found {} secs after login, check the username and password.'.format(timeout))
+            raise
+        latency = round(time.time() - start, 3)
+        logging.info('Logged in, latency: {} secs.'.format(latency))
+        return latency
+
     def login_page(self) -> None:
         """Enters to the login page. """
+        self._throttle(thr.Lane.NAVIGATION)
         self.driver.get(LOGIN_URL)
         logging.info('CCB accessed.')
 
@@ -261,6 +784,7 @@ class CCB:
         """
         self.set_username(username)
         self.set_password(password)
+        self._throttle(thr.Lane.NAVIGATION)
         self.driver.find_element(By.CSS_SELECTOR, '.btn-primary').click()
 
     def get_day(self, day: dt.date) -> None:
@@ -285,174 +809,322 @@ class CCB:
         self._driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
         day_button = self.driver.find_element(By.LINK_TEXT, strday)
         logging.info(day_button.get_attribute('href'))
+        self._throttle(thr.Lane.NAVIGATION)
         day_button.click()
         self._driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
         logging.info('Day found: {}'.format(strday))
 
-    def get_activities(self) -> typing.List[act.Activity]:
-        """Loop over elements of the table. """
-        # self.driver.find_element(By.CSS_SELECTOR, 'table-striped')
-        tables = self.driver.find_elements(By.CLASS_NAME, 'table-striped')
-        # There should be 2 tables, the first contains the days.
-        # Clicking on a day displays the second table with the same class name,
-        # containing the activities.
-        table = tables[1]
-        # logging.info('table found!')
-        activities = []
-        for i, row in enumerate(table.find_elements(By.CSS_SELECTOR, 'tr')):
-            if i > 1:  # The first says the Activities of the day, the second the names of each column.
-                row_elements = []
-                cells = row.find_elements(By.TAG_NAME, 'td')
-                if len(cells) > 4:
-                    # FIXME: Define a proper way of controlling this.
-                    # In this case we are already registered in a class, don't do anything yet
-                    pass
-
-                else:
-                    for j, cell in enumerate(cells):
-                        elem = self._parse_table_elem(j, cell)
-                        row_elements.append(elem)
-                    # Store as keyword arguments the information for the activities.
-                    name = row_elements[1]
-                    arguments = {'schedule': row_elements[0], 'reservation': row_elements[2], 'button': row_elements[3]}
-                    activity = self._get_activity(arguments, name)
-                    activities.append(activity)
-                    # logging.info(activity)
-
-        return activities
-
-    # @staticmethod
-    def _parse_table_elem(
-            self, pos: int, cell: we.WebElement
-    ) -> typing.Union[act.Schedule, act.Button, act.Reservation, str]:
-        """Parses each element of the table to its corresponding object.
+    @property
+    def tabs(self) -> typing.Dict[dt.date, str]:
+        """Window handles of the tabs opened by open_days, by day. """
+        return self._tabs
+
+    def open_days(self, days: typing.List[dt.date]) -> None:
+        """Opens one tab per day inside the same browser, each one showing
+        the table of activities of its day.
+
+        Must be called once logged in, with the calendar on the current tab.
+        The session cookies are shared between the tabs, so there is no need
+        to log in again on each of them.
 
         Parameters
         ----------
-        pos : int
-            Element of a row in the table of activities.
-        cell : we.WebElement
-            Element obtained from Selenium with info to create a full
-            object for the activities.
+        days : list of dt.date
+            Days to keep open.
 
-        Returns
-        -------
-        elem : Schedule, Button, Reservation or str
-            Element parsed and transformed to its given class to
-            simplify its interaction inside of an Activity.
+        Examples
+        --------
+        >>> ccb.open_days([dt.date(2020, 12, 13), dt.date(2020, 12, 14)])
+        >>> list(ccb.tabs.keys())
+        [datetime.date(2020, 12, 13), datetime.date(2020, 12, 14)]
         """
-        if pos == 0:  # Horario
-            elem = act.Schedule(cell.text)
-        elif pos == 1:  # Actividad
-            elem = cell.text
-        elif pos == 2:  # Reservas
-            elem = act.Reservation(cell.text)
-        elif pos == 3:  # Reservar
-            icon = None
-            if len(cell.text) > 0:
-                elem = cell.text
+        calendar_url = self.driver.current_url
+        for day in days:
+            if day in self._tabs:
+                continue
+            if len(self._tabs) == 0:
+                # Reuse the current tab for the first day.
+                handle = self.driver.current_window_handle
             else:
-                elem = cell.find_element(By.CSS_SELECTOR, 'a')
-                icon = cell.find_element_by_css_selector('span').get_attribute('class')
-            elem = act.Button(elem, self.driver, icon=icon)
-        else:
-            raise ValueError('This element is not expected: {}'.format(cell))
+                handles = set(self.driver.window_handles)
+                self._throttle(thr.Lane.NAVIGATION)
+                self.driver.execute_script("window.open(arguments[0]);", calendar_url)
+                handle = (set(self.driver.window_handles) - handles).pop()
+                self.driver.switch_to.window(handle)
 
-        return elem
+            self.get_day(day)
+            self._tabs[day] = handle
+            logging.info('Tab opened for day: {}'.format(day))
 
-    @staticmethod
-    def _get_activity(arguments: typing.Dict, name: str) -> act.Activity:
-        """Get the corresponding activity by the parsed info.
+    def switch_to_day(self, day: dt.date) -> None:
+        """Moves the driver to the tab of a given day, previously opened
+        with open_days.
 
         Parameters
         ----------
-        arguments : dict
-            Contains the dict with the names of the variables to instantiate
-            a given activity, and the proper object as a value.
-        name : str
-            The parsed element indicating the type of activity.
+        day : dt.date
+            Day to switch to.
+        """
+        try:
+            handle = self._tabs[day]
+        except KeyError:
+            raise KeyError("No tab opened for day: {}. Call open_days first.".format(day))
+        self.driver.switch_to.window(handle)
+
+    def close_day(self, day: dt.date) -> None:
+        """Closes the tab of a given day, if it was opened.
+
+        Parameters
+        ----------
+        day : dt.date
+            Day whose tab is no longer needed.
+        """
+        handle = self._tabs.pop(day, None)
+        if handle is None:
+            return
+        self.driver.switch_to.window(handle)
+        if len(self._tabs) > 0:
+            self.driver.close()
+            # The driver must point to an open window after closing one.
+            self.driver.switch_to.window(next(iter(self._tabs.values())))
+        logging.info('Tab closed for day: {}'.format(day))
+
+    def poll_days(self, refresh: bool = True) -> typing.Dict[dt.date, act.ActivityTable]:
+        """Reads the table of activities of every opened tab, round-robin, see get_table.
+
+        Switching between tabs requires no navigation, only the refresh
+        of each tab to get the current state of the reservations.
+
+        Parameters
+        ----------
+        refresh : bool
+            Whether to refresh each tab before reading its table.
+            Defaults to True.
 
         Returns
         -------
-        activity : act.Activity
-            Activity instantiated.
+        tables : dict
+            Maps each day to the table of activities found in its tab.
         """
-        if name == act.Activities.OPEN_BOX:
-            activity = act.OpenBox(**arguments)
+        tables = {}
+        for day in list(self._tabs):
+            self.switch_to_day(day)
+            if refresh:
+                self.refresh()
+            tables[day] = self.get_table()
 
-        elif name == act.Activities.CROSSFIT:
-            activity = act.Crossfit(**arguments)
+        return tables
 
-        elif name == act.Activities.CALISTHENICS:
-            activity = act.Calisthenics(**arguments)
+    def confirm_booking(self, activity: act.Activity, timeout: float = CONFIRM_TIMEOUT) -> bool:
+        """Re-reads the table of the current tab until the row of a booked
+        activity shows it as registered.
 
-        elif name == act.Activities.WEIGHTLIFTING:
-            activity = act.Weightlifting(**arguments)
+        A registered row either shows the minus icon, or gains the extra cell
+        of the classes already registered, see act.ActivityTable.registered.
 
-        else:
-            activity = None
-            warnings.warn('Activity unregistered: {}.'.format(activity))
+        Parameters
+        ----------
+        activity : act.Activity
+            Activity just booked from the current tab.
+        timeout : float
+            Max seconds waiting for the table. Defaults to CONFIRM_TIMEOUT.
+
+        Returns
+        -------
+        confirmed : bool
+            True if the booking shows in the table, False if the site didn't take it.
+        """
+        def registered(driver) -> bool:
+            table = self.get_table()
+            # An empty table is taken as a page not loaded yet.
+            if len(table) == 0:
+                return False
+            rows = table.find(str(activity.schedule), activity.name)
+            return len(rows) > 0 and all(table.registered[i] for i in rows)
 
-        return activity
+        try:
+            # The page may be reloading after the click.
+            WebDriverWait(
+                self.driver, timeout, poll_frequency=0.2, ignored_exceptions=(WebDriverException,)
+            ).until(registered)
+        except TimeoutException:
+            logging.info('Booking not confirmed: {}'.format(activity))
+            return False
+        logging.info('Booking confirmed: {}'.format(activity))
+        return True
+
+    def get_table(self) -> act.ActivityTable:
+        """Reads the whole table of activities in a single call to the driver,
+        parsing it by columns.
+
+        The Activity objects are only created for the rows asked to the table,
+        see act.ActivityTable.activity.
+        The rows of the classes already registered are flagged, see
+        act.ActivityTable.registered.
+
+        Returns
+        -------
+        table : act.ActivityTable
+        """
+        rows = self.driver.execute_script(TABLE_SCRIPT)
+        return act.ActivityTable(rows, self.driver, limiter=self.limiter)
 
     def close_page(self) -> None:
         """Call at the end of the program to close the window.
-        Has no effect on headless mode.
+
+        Quits the driver, closing every tab opened by open_days and ending
+        the session, which frees the node of a Remote WebDriver.
         """
         time.sleep(1)
-        self.driver.close()
+        self.driver.quit()
+        self._tabs = {}
 
     def refresh(self) -> None:
         """To be called ro reload the tables, maybe? """
+        self._throttle(thr.Lane.POLL)
         self.driver.refresh()
 
 
+def poll_once(ccb: CCB, targets: typing.List[Target]) -> typing.Tuple[typing.List[Target], typing.List[Target]]:
+    """Checks once the tabs opened in ccb, booking the wanted classes with a free place.
+
+    The free classes of every day are ranked by the priority of their targets
+    and only the best one of each day is booked, see decide. Once the booking
+    is confirmed in the table, the rest of the targets of the day are dropped.
+    A wanted class found registered, i.e. a booking confirmed after its
+    timeout, books its day the same way. The expired targets, and those whose
+    class is no longer in the table, are dropped too, and the tabs of the days
+    without targets are closed.
+
+    Parameters
+    ----------
+    ccb : CCB
+        Logged in, with the tabs of the days of the targets opened.
+    targets : list of Target
+        Work set of the poll loop.
+
+    Returns
+    -------
+    targets : list of Target
+        Targets left to book.
+    booked : list of Target
+        Targets booked in this poll.
+    """
+    targets = list(targets)
+    candidates = []
+    booked = []
+    # The tabs are refreshed on each poll, in case any button isn't where isn't expected.
+    for day, table in ccb.poll_days().items():
+        day_targets = [target for target in targets if target.day == day]
+        # A wanted class already registered books the day, even if its booking wasn't confirmed in time.
+        registered = next((
+            target for target in day_targets
+            if any(table.registered[i] for i in table.matching(target.classes, target.hour))
+        ), None)
+        if registered is not None:
+            logging.info('Class found registered: {}'.format(registered))
+            booked.append(registered)
+            continue
+
+        for target in day_targets:
+            # Check only the classes and hours selected for the day.
+            rows = table.matching(target.classes, target.hour)
+            if len(rows) == 0:
+                # The wanted classes no longer in the table can't be booked.
+                # An empty table is taken as a page not loaded yet.
+                if len(table) > 0:
+                    logging.info('Class not found, no longer checked: {}'.format(target))
+                    targets.remove(target)
+                continue
+
+            target.update_deadline(table.start(rows[0]))
+            if target.is_expired():
+                continue
+            # Only the rows wanted and free become activities.
+            for i in rows:
+                if table.bookable[i]:
+                    activity = table.activity(i)
+                    if activity is not None:
+                        candidates.append(Candidate(target, activity))
+
+    # Every free class of every day is ranked before clicking any of them.
+    for candidate in decide(candidates):
+        logging.info("Activity ({}): {}".format(candidate.day, candidate.activity))
+        ccb.switch_to_day(candidate.day)
+        # The target stays in the work set unless the table shows the booking.
+        if candidate.activity.book() and ccb.confirm_booking(candidate.activity):
+            booked.append(candidate.target)
+
+    booked_days = {target.day for target in booked}
+    targets = [target for target in targets if target.day not in booked_days]
+    targets = prune_targets(targets)
+    # Stop checking the days without anything left to book.
+    for day in set(ccb.tabs) - {target.day for target in targets}:
+        if len(ccb.tabs) > 1:
+            ccb.close_day(day)
+
+    return targets, booked
+
+
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='Books the classes of the config file.')
+    parser.add_argument(
+        '--profile', type=int, default=0, metavar='N',
+        help='Profile the first N iterations of the poll loop.'
+    )
+    parser.add_argument('--profile-dir', default='profile', help='Directory to write the profiles to.')
+    args = parser.parse_args()
+    profiler = prof.PollProfiler(args.profile, args.profile_dir) if args.profile > 0 else None
+
     parent = os.path.dirname(os.path.abspath(__file__))
     CONFIG_PATH = os.path.join(parent, 'config.json')
 
     config_file = JsonConfig(CONFIG_PATH)
     logging.info('Config file read. ')
-    ccb = CCB()
-    # Get login page of San Vicente centre..
-    ccb.login_page()
-
-    # Wait 2 seconds in case the time is needed to load the page.
-    time.sleep(2)
+    # At most one request every 2 seconds on average, with bursts of 5.
+    limiter = thr.RateLimiter(rate=RATE_LIMIT, capacity=RATE_BURST)
+    ccb = CCB(limiter=limiter)
 
     START = time.time()  # Initial time check, to allow stopping the program if a given time is elapsed.
     MAX_TIME_RUNNING = 3600  # 1 hour in seconds, total time allowed to run.
 
     # Get username and password to be sent.
     username, password = config_file.submit_info()
-    ccb.submit(username, password)
-
-    time.sleep(WAIT_FOR_CLOSE)
-    # dia = TODAY + period(days=1)
-    days = config_file.wanted_days()
-
-    # TODO: Loop over the list of days. For the moment only one
-    # TODO: Check for different hours and days
-    ccb.get_day(days[0])
-    activities = ccb.get_activities()
-    wanted_activities = config_file.wanted_classes()
-    wanted_hours = config_file.wanted_hours()
-    wanted_hour = wanted_hours[0]
-    is_booked = False
-    while not is_booked:
-        for activity in activities:
-            if activity.name in wanted_activities:  # Check only in those selected.
-                if wanted_hour in activity.schedule:  # Check for the hour.
-                    logging.info("Activity: {}".format(activity))
-                    is_booked = activity.book()
+    # Get login page of San Vicente centre..
+    ccb.login(username, password, fast=FAST_LOGIN)
+
+    # Only the targets inside the look-ahead horizon and not expired are kept.
+    targets = prune_targets(list(config_file.targets()))
+    days = sorted({target.day for target in targets})
+
+    # One tab per day, to check all of them without navigating between days.
+    ccb.open_days(days)
+    booked_days = 0
+    while len(targets) > 0:
+        if profiler is not None:
+            targets, booked = profiler.profile(poll_once, ccb, targets)
+        else:
+            targets, booked = poll_once(ccb, targets)
+        for target in booked:
+            logging.info('Class booked: {}'.format(target))
+        booked_days += len(booked)
 
         time_elapsed = round(time.time() - START, 2)
-        logging.info("is_booked: {}, time elapsed: {} secs.".format(is_booked, time_elapsed))
-        ccb.refresh()  # refresh the page in case any button isn't where isn't expected.
+        logging.info("Targets left: {}, time elapsed: {} secs.".format(len(targets), time_elapsed))
+        logging.info("Rate limiter queueing: {}".format(limiter.stats()))
+
+        # Close the page once every day is booked or nothing is left to book,
+        # or if the max time running is reached, like the workers of the coordinator.
+        if len(targets) == 0 or time_elapsed > MAX_TIME_RUNNING:
+            break
         time.sleep(5)
 
-        # Close the page if a class is booked or if the max time running is reached
-        if is_booked or time_elapsed > MAX_TIME_RUNNING:
-            ccb.close_page()
-            sys.exit()
+    for target in targets:
+        logging.info('Target left unbooked: {}'.format(target))
+    if len(targets) == 0:
+        logging.info('Nothing left to book, days booked: {}.'.format(booked_days))
+    if profiler is not None:
+        profiler.finish()
+    ccb.close_page()
+    sys.exit()
@@ -0,0 +1,269 @@
+"""
+Profiling of the poll loop.
+The profiled iterations alternate between cProfile, and a thread sampling
+the stack of the poll to write collapsed stacks for flamegraphs
+(flamegraph.pl, speedscope...). The samples are split between the time
+spent in python, the time blocked on the WebDriver requests, and the time
+waiting for the rate limiter.
+"""
+
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import typing
+import collections
+
+
+# Set default message from config to be info, and prettier format:
+logging.basicConfig(format='%(asctime)s --> %(levelname)s: %(message)s', level=logging.INFO)
+
+
+SAMPLE_INTERVAL = 0.005  # Seconds between stack samples.
+
+# Functions whose stats are logged after the profiled iterations.
+HOT_PATH = (
+    'poll_once', 'get_table', 'parse_reservations', 'parse_schedules', 'activity', 'book', 'confirm_booking'
+)
+
+
+class Category:
+    """Root frame of the collapsed stacks, where the time of a sample goes. """
+    PYTHON = 'python'
+    WEBDRIVER_IO = 'webdriver-io'
+    THROTTLE = 'throttle'
+
+
+# Modules whose frames mean the poll is blocked on a request to the WebDriver.
+_IO_FILES = (
+    'remote_connection.py',
+    os.path.join('http', 'client.py'),
+    'socket.py',
+    'ssl.py',
+    os.path.join('urllib3', ''),
+)
+_THROTTLE_FILE = os.path.join('ccb', 'throttle.py')
+
+
+def _frame_name(frame) -> str:
+    """Name of a frame in the collapsed stacks: module:function. """
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return '{}:{}'.format(module, code.co_name)
+
+
+def _categorize(filenames: typing.List[str]) -> str:
+    """Category of a sample given the files of its frames. """
+    for filename in filenames:
+        if filename.endswith(_THROTTLE_FILE):
+            return Category.THROTTLE
+    for filename in filenames:
+        if any(io_file in filename for io_file in _IO_FILES):
+            return Category.WEBDRIVER_IO
+    return Category.PYTHON
+
+
+class _Sampler(threading.Thread):
+    """Samples the stack of a thread at regular intervals. """
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL) -> None:
+        super().__init__(daemon=True)
+        self._thread_id = thread_id
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self.stacks = collections.Counter()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            names, filenames = [], []
+            while frame is not None:
+                names.append(_frame_name(frame))
+                filenames.append(frame.f_code.co_filename)
+                frame = frame.f_back
+            if len(names) == 0:
+                continue
+            # The collapsed format goes from the root to the leaf.
+            names.append(_categorize(filenames))
+            self.stacks[';'.join(reversed(names))] += 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+class PollProfiler:
+    """Profiles a given number of iterations of the poll loop.
+
+    The profilers would measure each other, so they never run on the same
+    iteration: odd iterations run under cProfile, and even iterations are
+    sampled and timed. The CPU time is the thread time of the polled thread
+    on the sampled iterations, which leaves out the sampler thread and the
+    overhead of cProfile. Profile at least 2 iterations to get both.
+
+    Writes to output_dir a .pstats file per cProfile iteration (poll-001.pstats,
+    poll-003.pstats...), poll.pstats with all of them, and poll.collapsed with
+    the sampled stacks, whose root frame is the category of the sample
+    (see Category).
+
+    Parameters
+    ----------
+    iterations : int
+        Number of iterations to profile.
+    output_dir : str
+        Directory to write the profiles to, created if needed.
+    interval : float
+        Seconds between stack samples. Defaults to SAMPLE_INTERVAL.
+
+    Methods
+    -------
+    profile
+    finish
+    summary
+
+    Examples
+    --------
+    >>> profiler = PollProfiler(4, 'profile')
+    >>> while not profiler.done:
+    ...     targets, booked = profiler.profile(poll_once, ccb, targets)
+    """
+    def __init__(self, iterations: int, output_dir: str, interval: float = SAMPLE_INTERVAL) -> None:
+        if iterations < 1:
+            raise ValueError('iterations must be at least 1.')
+        self.iterations = iterations
+        self.output_dir = output_dir
+        self.interval = interval
+        self._count = 0
+        self._stacks = collections.Counter()
+        self._times = []  # (wall, cpu) of each sampled iteration.
+        self._pstats_files = []
+        self._written = False
+
+    def __repr__(self):
+        return '{}({}/{}, {})'.format(self.__class__.__name__, self._count, self.iterations, self.output_dir)
+
+    @property
+    def done(self) -> bool:
+        """True once every iteration has been profiled. """
+        return self._count >= self.iterations
+
+    def profile(self, func: typing.Callable, *args, **kwargs) -> typing.Any:
+        """Calls func as a profiled iteration, writing the results after the last one.
+
+        Parameters
+        ----------
+        func : callable
+            Iteration of the poll loop, i.e. poll_once.
+        args, kwargs
+            Arguments passed to func.
+
+        Returns
+        -------
+        result : any
+            Return value of func.
+        """
+        if self.done:
+            return func(*args, **kwargs)
+
+        self._count += 1
+        if self._count % 2 == 1:
+            result = self._cprofile(func, *args, **kwargs)
+        else:
+            result = self._sample(func, *args, **kwargs)
+
+        if self.done:
+            self.finish()
+        return result
+
+    def _cprofile(self, func: typing.Callable, *args, **kwargs) -> typing.Any:
+        """Calls func under cProfile, writing its .pstats file. """
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            profiler.disable()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, 'poll-{:03d}.pstats'.format(self._count))
+        profiler.dump_stats(path)
+        self._pstats_files.append(path)
+        logging.info('Profiled iteration {}/{} (cProfile): {}'.format(self._count, self.iterations, path))
+        return result
+
+    def _sample(self, func: typing.Callable, *args, **kwargs) -> typing.Any:
+        """Calls func while sampling its stack, measuring its wall and thread time. """
+        sampler = _Sampler(threading.get_ident(), interval=self.interval)
+        sampler.start()
+        # The thread time only counts the CPU of this thread, not the sampler's.
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            sampler.stop()
+
+        self._stacks.update(sampler.stacks)
+        self._times.append((wall, cpu))
+        logging.info('Profiled iteration {}/{} (sampled): wall {:.3f}, cpu {:.3f} secs.'.format(
+            self._count, self.iterations, wall, cpu
+        ))
+        return result
+
+    def summary(self) -> typing.Dict[str, float]:
+        """Time of the sampled iterations, in seconds.
+
+        The python CPU time is the thread time of the polled thread, and the
+        time blocked on the WebDriver and the rate limiter is estimated from
+        the share of samples spent on them.
+
+        Returns
+        -------
+        summary : dict
+            Number of sampled iterations, and their wall, cpu, webdriver-io
+            and throttle time.
+        """
+        wall = sum(w for w, _ in self._times)
+        cpu = sum(c for _, c in self._times)
+        samples = collections.Counter()
+        for stack, count in self._stacks.items():
+            samples[stack.split(';', 1)[0]] += count
+        total = sum(samples.values())
+
+        summary = {'sampled': len(self._times), 'wall': round(wall, 3), 'cpu': round(cpu, 3)}
+        for category in (Category.WEBDRIVER_IO, Category.THROTTLE):
+            share = samples[category] / total if total > 0 else 0.
+            summary[category] = round(wall * share, 3)
+        return summary
+
+    def finish(self) -> None:
+        """Writes the combined pstats and the collapsed stacks, and logs the hot path.
+
+        Called after the last iteration, call it when the loop stops before
+        to keep the iterations profiled so far.
+        """
+        if self._written or self._count == 0:
+            return
+        self._written = True
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        if len(self._times) > 0:
+            collapsed = os.path.join(self.output_dir, 'poll.collapsed')
+            with open(collapsed, 'w') as f:
+                for stack, count in sorted(self._stacks.items()):
+                    f.write('{} {}\n'.format(stack, count))
+            logging.info('Collapsed stacks written: {}'.format(collapsed))
+            logging.info('Poll loop time (secs): {}'.format(self.summary()))
+
+        if len(self._pstats_files) > 0:
+            stats = pstats.Stats(*self._pstats_files)
+            path = os.path.join(self.output_dir, 'poll.pstats')
+            stats.dump_stats(path)
+            logging.info('Profiles written: {}'.format(path))
+            for (filename, lineno, funcname), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+                if funcname in HOT_PATH and os.path.join('ccb', '') in filename:
+                    logging.info('{}:{}({}): {} calls, tottime {:.4f}, cumtime {:.4f} secs.'.format(
+                        os.path.basename(filename), lineno, funcname, ncalls, tottime, cumtime
+                    ))
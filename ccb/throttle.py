@@ -0,0 +1,168 @@
+"""
+Rate limiting of the requests sent to the web page.
+A single token bucket is shared by every request issued from CCB
+(navigation, refresh and booking), across threads and processes,
+to avoid getting throttled or banned by the page.
+"""
+
+import logging
+import multiprocessing as mp
+import time
+import typing
+
+
+# Set default message from config to be info, and prettier format:
+logging.basicConfig(format='%(asctime)s --> %(levelname)s: %(message)s', level=logging.INFO)
+
+
+class Lane:
+    """
+    Priority lanes of the rate limiter.
+    BOOKING never waits, it may take the bucket into debt which is paid
+    by the lower lanes. NAVIGATION waits for a token, and POLL
+    waits for a token leaving the reserve untouched, so routine polls
+    never eat the budget kept for the rest.
+    """
+    BOOKING = 'BOOKING'
+    NAVIGATION = 'NAVIGATION'
+    POLL = 'POLL'
+
+
+LANES = (Lane.BOOKING, Lane.NAVIGATION, Lane.POLL)
+
+
+class RateLimiter:
+    """Token bucket shared across threads and processes.
+
+    The state of the bucket lives in shared memory, so the same instance
+    can be passed to the processes started with multiprocessing (it must be
+    created before them), and every thread or process draws from the
+    same budget.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added to the bucket per second, i.e. the sustained
+        number of requests per second allowed.
+    capacity : float
+        Maximum number of tokens in the bucket, i.e. the size of the
+        bursts allowed.
+    reserve : float
+        Tokens only available to the BOOKING and NAVIGATION lanes.
+        Defaults to 1.
+
+    Methods
+    -------
+    acquire
+    stats
+
+    Examples
+    --------
+    >>> limiter = RateLimiter(rate=0.5, capacity=5)
+    >>> limiter.acquire(Lane.POLL)
+    0.0
+    >>> limiter.stats()[Lane.POLL]
+    {'requests': 1, 'delay': 0.0, 'mean_delay': 0.0, 'max_delay': 0.0}
+    """
+    def __init__(self, rate: float, capacity: float, reserve: float = 1.) -> None:
+        if rate <= 0 or capacity < 1:
+            raise ValueError('rate must be positive and capacity at least 1.')
+        if not 0 <= reserve < capacity:
+            raise ValueError('reserve must be in [0, capacity).')
+        self._rate = rate
+        self._capacity = capacity
+        self._reserve = reserve
+        self._lock = mp.Lock()
+        self._tokens = mp.RawValue('d', capacity)
+        self._last = mp.RawValue('d', time.monotonic())
+        # Queueing statistics per lane: number of requests, total and max delay.
+        self._requests = mp.RawArray('L', len(LANES))
+        self._delay = mp.RawArray('d', len(LANES))
+        self._max_delay = mp.RawArray('d', len(LANES))
+
+    def __repr__(self):
+        return '{}(rate={}, capacity={}, reserve={})'.format(
+            self.__class__.__name__, self._rate, self._capacity, self._reserve
+        )
+
+    def _refill(self, now: float) -> None:
+        """Adds the tokens accumulated since the last refill. Must be called with the lock held. """
+        elapsed = max(now - self._last.value, 0.)
+        self._tokens.value = min(self._capacity, self._tokens.value + elapsed * self._rate)
+        self._last.value = now
+
+    def _floor(self, lane: str) -> float:
+        """Tokens that must remain in the bucket after a request of a given lane. """
+        if lane == Lane.BOOKING:
+            return float('-inf')
+        elif lane == Lane.NAVIGATION:
+            return 0.
+        else:
+            return self._reserve
+
+    def acquire(self, lane: str = Lane.POLL) -> float:
+        """Blocks until a request of the given lane is allowed.
+
+        Parameters
+        ----------
+        lane : str
+            One of the lanes defined in Lane. Defaults to Lane.POLL.
+
+        Returns
+        -------
+        delay : float
+            Seconds spent waiting in the queue, 0 if the request
+            was allowed right away.
+        """
+        if lane not in LANES:
+            raise ValueError('lane must be one of: {}.'.format(LANES))
+
+        floor = self._floor(lane)
+        start = time.monotonic()
+        waited = False
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens.value - 1 >= floor:
+                    self._tokens.value -= 1
+                    # Only the time slept counts as queueing delay.
+                    delay = now - start if waited else 0.
+                    self._record(lane, delay)
+                    break
+                # Time until enough tokens are available for this lane.
+                wait = (floor + 1 - self._tokens.value) / self._rate
+            time.sleep(wait)
+            waited = True
+
+        if delay > 0:
+            logging.debug('{} request waited {:.3f} secs.'.format(lane, delay))
+        return delay
+
+    def _record(self, lane: str, delay: float) -> None:
+        """Updates the queueing statistics. Must be called with the lock held. """
+        i = LANES.index(lane)
+        self._requests[i] += 1
+        self._delay[i] += delay
+        self._max_delay[i] = max(self._max_delay[i], delay)
+
+    def stats(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        """Queueing delay observed by each lane, to size the budget.
+
+        Returns
+        -------
+        stats : dict
+            For each lane, the number of requests, the total, mean and max
+            delay in seconds.
+        """
+        stats = {}
+        with self._lock:
+            for i, lane in enumerate(LANES):
+                requests = self._requests[i]
+                stats[lane] = {
+                    'requests': requests,
+                    'delay': round(self._delay[i], 3),
+                    'mean_delay': round(self._delay[i] / requests, 3) if requests > 0 else 0.,
+                    'max_delay': round(self._max_delay[i], 3),
+                }
+        return stats